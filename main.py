@@ -3,24 +3,48 @@ import logging
 import os
 import asyncpg
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.default import DefaultBotProperties
+from aiogram.fsm.storage.redis import RedisStorage
 from dotenv import load_dotenv
 from aiogram import BaseMiddleware
 from typing import Callable, Dict, Any, Awaitable
 from aiogram.types import TelegramObject
+from redis.asyncio import Redis
 
 from src.bot.handlers.user import user_router
 from src.database.setup import create_tables
-from src.bot.scheduler import start_scheduler
+from src.bot.scheduler import start_scheduler, MAX_CONCURRENCY
 from src.database.repository import DatabaseRepo
+from src.parser.scraper import AutoRiaScraper
+
+# Unfinished subscription flows expire after 24 hours
+FSM_TTL = 24 * 3600
 
 class DbSessionMiddleware(BaseMiddleware):
     """
     Middleware that injects a Database Repository instance into every handler.
-    Manages connection acquisition and release from the pool.
+    The repository acquires pool connections per query, so handlers doing
+    network I/O do not hold a connection for their whole duration.
     """
     def __init__(self, pool):
-        self.pool = pool
+        self.repo = DatabaseRepo(pool)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        data['repo'] = self.repo
+        return await handler(event, data)
+
+class ScraperMiddleware(BaseMiddleware):
+    """
+    Middleware that injects the shared AutoRiaScraper instance into every handler,
+    so all requests reuse one HTTP session (keep-alive connection pool).
+    """
+    def __init__(self, scraper: AutoRiaScraper):
+        self.scraper = scraper
 
     async def __call__(
         self,
@@ -28,9 +52,8 @@ class DbSessionMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        async with self.pool.acquire() as connection:
-            data['repo'] = DatabaseRepo(connection)
-            return await handler(event, data)
+        data['scraper'] = self.scraper
+        return await handler(event, data)
 
 async def main():
     load_dotenv()
@@ -48,6 +71,7 @@ async def main():
     # Docker friendly host resolution
     db_host = os.getenv("DB_HOST", "db") 
     db_port = os.getenv("DB_PORT", "5432")
+    redis_url = os.getenv("REDIS_URL", "redis://redis:6379/0")
 
     if not bot_token:
         print("Error: BOT_TOKEN is not set")
@@ -60,9 +84,22 @@ async def main():
     # Retry logic for container startup race conditions
     for i in range(5):
         try:
-            pool = await asyncpg.create_pool(dsn)
+            # Warm pool sized for the scheduler workers plus bot handlers;
+            # each connection keeps a cache of prepared statements.
+            # JIT is disabled as a startup parameter (our queries are tiny OLTP lookups,
+            # where JIT compilation only adds latency), so the `RESET ALL` asyncpg runs
+            # when a connection is released returns to it instead of re-enabling JIT.
+            pool = await asyncpg.create_pool(
+                dsn,
+                min_size=MAX_CONCURRENCY,
+                max_size=MAX_CONCURRENCY * 2,
+                statement_cache_size=200,
+                max_inactive_connection_lifetime=300,
+                command_timeout=30,
+                server_settings={"jit": "off"},
+            )
             print("Connected to database")
-            await create_tables()
+            await create_tables(pool)
             break
         except Exception as e:
             print(f"Waiting for database... ({e})")
@@ -73,25 +110,40 @@ async def main():
         return
 
     # 3. Bot Initialization
-    bot = Bot(token=bot_token)
-    dp = Dispatcher(storage=MemoryStorage())
+    bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode="HTML"))
+    # FSM state lives in Redis: it survives restarts and can be shared by several bot instances
+    redis = Redis.from_url(redis_url)
+    storage = RedisStorage(redis=redis, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    dp = Dispatcher(storage=storage)
+    # Reference data (brands/regions/models) is persisted in the same Redis
+    scraper = AutoRiaScraper(max_connections=MAX_CONCURRENCY * 2, redis=redis)
     
     dp.update.middleware(DbSessionMiddleware(pool))
+    dp.update.middleware(ScraperMiddleware(scraper))
     dp.include_router(user_router)
 
     print("Bot started")
     
     try:
         # Run scheduler in background
-        asyncio.create_task(start_scheduler(bot, pool))
+        asyncio.create_task(start_scheduler(bot, pool, scraper))
         await dp.start_polling(bot)
     finally:
+        await scraper.close()
+        await storage.close()
         await pool.close()
 
 if __name__ == "__main__":
     try:
         if os.name == 'nt':
              asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        else:
+            # uvloop is an optional speedup (not available on Windows)
+            try:
+                import uvloop
+                uvloop.install()
+            except ImportError:
+                pass
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         print("Bot stopped")
\ No newline at end of file
@@ -1,5 +1,9 @@
 from __future__ import annotations
 
+import asyncio
+import logging
+from html import escape
+
 from aiogram import Router, F, types
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
@@ -15,10 +19,16 @@ from src.bot.keyboards import (
 )
 from src.bot.states import SubscriptionForm
 from src.parser.scraper import AutoRiaScraper
+from src.parser.cache import get_brands_cached, get_models_cached, get_regions_cached
 from src.database.repository import DatabaseRepo
 
+logger = logging.getLogger(__name__)
+
 user_router = Router()
 
+# Strong references to fire-and-forget tasks (the event loop keeps only weak ones)
+_background_tasks: set[asyncio.Task] = set()
+
 # -----------------------------
 # Constant Maps
 # -----------------------------
@@ -44,12 +54,26 @@ GEARBOX_MAP = {
 # -----------------------------
 # Helpers
 # -----------------------------
-def _find_name_by_id(items: list[dict], item_id: int, fallback: str = "") -> str:
-    """Helper to find the human-readable name of an item by its ID."""
-    for it in items:
-        if int(it.get("id")) == int(item_id):
-            return str(it.get("name"))
-    return fallback
+def _find_name_by_id(
+    items: list[dict],
+    item_id: int,
+    fallback: str = "",
+    id_to_name: dict[int, str] | None = None,
+) -> str:
+    """
+    Helper to find the human-readable name of an item by its ID.
+    Pass a precomputed `id_to_name` (from src.parser.cache) for an O(1) lookup.
+    """
+    if id_to_name is None:
+        id_to_name = {int(it["id"]): str(it["name"]) for it in items}
+    return id_to_name.get(int(item_id), fallback)
+
+
+async def _filter_models(scraper: AutoRiaScraper, brand_id: int, query: str) -> list[dict]:
+    """Case-insensitive substring search over the cached models of a brand."""
+    models, _, lowered_names = await get_models_cached(scraper, brand_id)
+    q = query.lower()
+    return [models[i] for i, name in enumerate(lowered_names) if q in name]
 
 
 def _build_models_keyboard(models: list[dict], *, page: int = 0, mode: str = "all"):
@@ -93,30 +117,22 @@ async def cmd_start(message: types.Message, repo: DatabaseRepo):
 
 
 @user_router.message(F.text == "🔍 Створити підписку")
-async def start_sub(message: types.Message, state: FSMContext):
+async def start_sub(message: types.Message, state: FSMContext, scraper: AutoRiaScraper):
     """Starts the subscription creation flow. Fetches brands."""
-    scraper = AutoRiaScraper()
-    brands = await scraper.get_brands()
+    brands, _ = await get_brands_cached(scraper)
     if not brands:
         return await message.answer("⚠️ Не вдалося завантажити список марок. Спробуй пізніше.")
 
-    await state.update_data(brands=brands, brand_page=0)
+    await state.update_data(brand_page=0)
     await message.answer("🚗 Обери марку:", reply_markup=build_brands_keyboard(brands, page=0))
     await state.set_state(SubscriptionForm.choosing_brand)
 
 
 @user_router.callback_query(F.data.startswith("brand_page:"), SubscriptionForm.choosing_brand)
-async def process_brand_page(callback: types.CallbackQuery, state: FSMContext):
+async def process_brand_page(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Pagination handler for Brands."""
     page = int(callback.data.split(":")[1])
-    data = await state.get_data()
-    brands = data.get("brands") or []
-    
-    # Refetch if state data is lost
-    if not brands:
-        scraper = AutoRiaScraper()
-        brands = await scraper.get_brands()
-        await state.update_data(brands=brands)
+    brands, _ = await get_brands_cached(scraper)
 
     await state.update_data(brand_page=page)
     await callback.message.edit_reply_markup(reply_markup=build_brands_keyboard(brands, page=page))
@@ -124,41 +140,59 @@ async def process_brand_page(callback: types.CallbackQuery, state: FSMContext):
 
 
 @user_router.callback_query(F.data.startswith("brand:"), SubscriptionForm.choosing_brand)
-async def process_brand(callback: types.CallbackQuery, state: FSMContext):
-    """Handles Brand selection. Triggers Model fetching."""
+async def process_brand(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
+    """
+    Handles Brand selection. Acknowledges the callback right away and
+    loads the models in a background task, so the update is not blocked by HTTP.
+    """
     brand_id = int(callback.data.split(":")[1])
 
-    data = await state.get_data()
-    brands = data.get("brands") or []
-    brand_name = _find_name_by_id(brands, brand_id, fallback=str(brand_id))
+    _, brand_names = await get_brands_cached(scraper)
+    brand_name = brand_names.get(brand_id, str(brand_id))
 
     await state.update_data(brand_id=brand_id, brand_name=brand_name)
+    await state.set_state(SubscriptionForm.choosing_model)
+    await callback.answer()
 
-    await callback.message.edit_text(f"⏳ Завантажую моделі {brand_name}...")
-    scraper = AutoRiaScraper()
-    models = await scraper.get_models(brand_id)
+    await callback.message.edit_text(f"⏳ Завантажую моделі {escape(brand_name)}...")
+    task = asyncio.create_task(_load_models_and_reply(callback, state, brand_id, brand_name, scraper))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-    # If no models found (or empty), allow user to skip to Year selection
-    if not models:
-        await state.update_data(model_id=0, model_name="Будь-яка")
-        await callback.message.answer("📅 Рік ВІД (наприклад 2010):", reply_markup=get_skip_keyboard())
-        await state.set_state(SubscriptionForm.choosing_year_from)
-        return
 
-    await state.update_data(models_all=models, model_page=0, model_mode="all")
+async def _load_models_and_reply(
+    callback: types.CallbackQuery,
+    state: FSMContext,
+    brand_id: int,
+    brand_name: str,
+    scraper: AutoRiaScraper,
+):
+    """Fetches the models of the chosen brand and shows the model keyboard."""
+    try:
+        models, _, _ = await get_models_cached(scraper, brand_id)
 
-    kb = _build_models_keyboard(models, page=0, mode="all")
-    await callback.message.delete()
-    await callback.message.answer(f"🚗 Обери модель **{brand_name}**:", reply_markup=kb, parse_mode="Markdown")
-    await state.set_state(SubscriptionForm.choosing_model)
+        # If no models found (or empty), allow user to skip to Year selection
+        if not models:
+            await state.update_data(model_id=0, model_name="Будь-яка")
+            await callback.message.answer("📅 Рік ВІД (наприклад 2010):", reply_markup=get_skip_keyboard())
+            await state.set_state(SubscriptionForm.choosing_year_from)
+            return
+
+        await state.update_data(model_page=0, model_mode="all")
+
+        kb = _build_models_keyboard(models, page=0, mode="all")
+        await callback.message.delete()
+        await callback.message.answer(f"🚗 Обери модель <b>{escape(brand_name)}</b>:", reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Failed to load models for brand {brand_id}: {e}")
 
 
 @user_router.callback_query(F.data.startswith("model_page:"), SubscriptionForm.choosing_model)
-async def process_model_page(callback: types.CallbackQuery, state: FSMContext):
+async def process_model_page(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Pagination for Models (All mode)."""
     page = int(callback.data.split(":")[1])
     data = await state.get_data()
-    models = data.get("models_all") or []
+    models, _, _ = await get_models_cached(scraper, int(data.get("brand_id", 0)))
     await state.update_data(model_page=page, model_mode="all")
     await callback.message.edit_reply_markup(reply_markup=_build_models_keyboard(models, page=page, mode="all"))
     await callback.answer()
@@ -173,43 +207,41 @@ async def start_model_search(callback: types.CallbackQuery, state: FSMContext):
 
 
 @user_router.message(SubscriptionForm.choosing_model_search)
-async def process_model_search_text(message: types.Message, state: FSMContext):
+async def process_model_search_text(message: types.Message, state: FSMContext, scraper: AutoRiaScraper):
     """Filters the model list based on user text input."""
     query = (message.text or "").strip()
     if len(query) < 2:
         return await message.answer("❌ Введи хоча б 2 символи для пошуку.")
 
     data = await state.get_data()
-    models_all = data.get("models_all") or []
-    q = query.lower()
-
-    filtered = [m for m in models_all if q in str(m.get("name", "")).lower()]
+    filtered = await _filter_models(scraper, int(data.get("brand_id", 0)), query)
     if not filtered:
         return await message.answer("😕 Нічого не знайшов. Спробуй інший запит або коротше/довше слово.")
 
-    await state.update_data(models_search=filtered, model_mode="search", model_page=0, model_search_query=query)
+    # Only the query is kept in state; results are recomputed from the cache
+    await state.update_data(model_mode="search", model_page=0, model_search_query=query)
 
     kb = _build_models_keyboard(filtered, page=0, mode="search")
-    await message.answer(f"🔎 Результати для: <b>{query}</b> (знайдено {len(filtered)})", reply_markup=kb, parse_mode="HTML")
+    await message.answer(f"🔎 Результати для: <b>{escape(query)}</b> (знайдено {len(filtered)})", reply_markup=kb)
     await state.set_state(SubscriptionForm.choosing_model)
 
 
 @user_router.callback_query(F.data == "model_back", SubscriptionForm.choosing_model)
-async def back_to_all_models(callback: types.CallbackQuery, state: FSMContext):
+async def back_to_all_models(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Returns to the full list of models."""
     data = await state.get_data()
-    models_all = data.get("models_all") or []
+    models_all, _, _ = await get_models_cached(scraper, int(data.get("brand_id", 0)))
     await state.update_data(model_mode="all", model_page=0)
     await callback.message.edit_reply_markup(reply_markup=_build_models_keyboard(models_all, page=0, mode="all"))
     await callback.answer()
 
 
 @user_router.callback_query(F.data.startswith("modelS_page:"), SubscriptionForm.choosing_model)
-async def process_model_search_page(callback: types.CallbackQuery, state: FSMContext):
+async def process_model_search_page(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Pagination for Models (Search mode)."""
     page = int(callback.data.split(":")[1])
     data = await state.get_data()
-    models = data.get("models_search") or []
+    models = await _filter_models(scraper, int(data.get("brand_id", 0)), data.get("model_search_query", ""))
     await state.update_data(model_page=page, model_mode="search")
     await callback.message.edit_reply_markup(reply_markup=_build_models_keyboard(models, page=page, mode="search"))
     await callback.answer()
@@ -217,7 +249,7 @@ async def process_model_search_page(callback: types.CallbackQuery, state: FSMCon
 
 @user_router.callback_query(F.data.startswith("model:"), SubscriptionForm.choosing_model)
 @user_router.callback_query(F.data.startswith("modelS:"), SubscriptionForm.choosing_model)
-async def process_model(callback: types.CallbackQuery, state: FSMContext):
+async def process_model(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Handles Model selection."""
     model_id = int(callback.data.split(":")[1])
 
@@ -225,14 +257,12 @@ async def process_model(callback: types.CallbackQuery, state: FSMContext):
         model_name = "Будь-яка"
     else:
         data = await state.get_data()
-        mode = data.get("model_mode", "all")
-        models = data.get("models_search") if mode == "search" else data.get("models_all")
-        models = models or []
-        model_name = _find_name_by_id(models, model_id, fallback=str(model_id))
+        _, model_names, _ = await get_models_cached(scraper, int(data.get("brand_id", 0)))
+        model_name = model_names.get(model_id, str(model_id))
 
     await state.update_data(model_id=model_id, model_name=model_name)
 
-    await callback.message.edit_text(f"✅ Модель: <b>{model_name}</b>", parse_mode="HTML")
+    await callback.message.edit_text(f"✅ Модель: <b>{escape(model_name)}</b>")
     await callback.message.answer("📅 Рік ВІД (наприклад 2010):", reply_markup=get_skip_keyboard())
     await state.set_state(SubscriptionForm.choosing_year_from)
     await callback.answer()
@@ -273,14 +303,13 @@ async def process_price_from(message: types.Message, state: FSMContext):
 # DYNAMIC REGIONS LOGIC
 # -----------------------------
 @user_router.message(SubscriptionForm.choosing_price_to)
-async def process_price_to(message: types.Message, state: FSMContext):
+async def process_price_to(message: types.Message, state: FSMContext, scraper: AutoRiaScraper):
     pt = int(message.text) if (message.text or "").isdigit() else 0
     await state.update_data(price_to=pt)
 
     # 1. Fetch regions from AutoRia dynamically
     await message.answer("⏳ Завантажую список областей...")
-    scraper = AutoRiaScraper()
-    regions = await scraper.get_states()
+    regions, _ = await get_regions_cached(scraper)
 
     if not regions:
         # Fallback if API is down
@@ -290,8 +319,8 @@ async def process_price_to(message: types.Message, state: FSMContext):
         await state.set_state(SubscriptionForm.choosing_fuel)
         return
 
-    # 2. Save regions to state (to look up names later)
-    await state.update_data(regions=regions, region_page=0)
+    # 2. Only the page is kept in state; names are resolved from the cache later
+    await state.update_data(region_page=0)
 
     # 3. Show keyboard
     await message.answer("📍 Обери область:", reply_markup=build_regions_keyboard(regions, page=0))
@@ -299,16 +328,10 @@ async def process_price_to(message: types.Message, state: FSMContext):
 
 
 @user_router.callback_query(F.data.startswith("region_page:"), SubscriptionForm.choosing_region)
-async def process_region_page(callback: types.CallbackQuery, state: FSMContext):
+async def process_region_page(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Pagination for Regions."""
     page = int(callback.data.split(":")[1])
-    data = await state.get_data()
-    regions = data.get("regions") or []
-    
-    if not regions:
-        scraper = AutoRiaScraper()
-        regions = await scraper.get_states()
-        await state.update_data(regions=regions)
+    regions, _ = await get_regions_cached(scraper)
 
     await state.update_data(region_page=page)
     await callback.message.edit_reply_markup(reply_markup=build_regions_keyboard(regions, page=page))
@@ -316,20 +339,19 @@ async def process_region_page(callback: types.CallbackQuery, state: FSMContext):
 
 
 @user_router.callback_query(F.data.startswith("region:"), SubscriptionForm.choosing_region)
-async def process_region(callback: types.CallbackQuery, state: FSMContext):
+async def process_region(callback: types.CallbackQuery, state: FSMContext, scraper: AutoRiaScraper):
     """Handles Region selection."""
     region_id = int(callback.data.split(":")[1])
     
     if region_id == 0:
         region_name = "Вся Україна"
     else:
-        data = await state.get_data()
-        regions = data.get("regions") or []
-        region_name = _find_name_by_id(regions, region_id, fallback=str(region_id))
+        _, region_names = await get_regions_cached(scraper)
+        region_name = region_names.get(region_id, str(region_id))
 
     await state.update_data(region_id=region_id, region_name=region_name)
 
-    await callback.message.edit_text(f"✅ Область: <b>{region_name}</b>", parse_mode="HTML")
+    await callback.message.edit_text(f"✅ Область: <b>{escape(region_name)}</b>")
     await callback.message.answer("⛽ Тип палива:", reply_markup=get_fuel_keyboard())
     await state.set_state(SubscriptionForm.choosing_fuel)
     await callback.answer()
@@ -341,7 +363,7 @@ async def process_fuel(callback: types.CallbackQuery, state: FSMContext):
     fuel_name = FUEL_MAP.get(fuel_id, str(fuel_id))
     await state.update_data(fuel_id=fuel_id, fuel_name=fuel_name)
 
-    await callback.message.edit_text(f"✅ Паливо: <b>{fuel_name}</b>", parse_mode="HTML")
+    await callback.message.edit_text(f"✅ Паливо: <b>{fuel_name}</b>")
     await callback.message.answer("⚙️ Коробка передач:", reply_markup=get_gearbox_keyboard())
     await state.set_state(SubscriptionForm.choosing_gearbox)
     await callback.answer()
@@ -358,24 +380,24 @@ async def process_save(callback: types.CallbackQuery, state: FSMContext, repo: D
 
     data = await state.get_data()
 
-    await callback.message.edit_text(f"✅ Коробка: <b>{gearbox_name}</b>", parse_mode="HTML")
+    await callback.message.edit_text(f"✅ Коробка: <b>{gearbox_name}</b>")
 
     try:
         await repo.add_search(callback.from_user.id, data)
 
-        model_part = f" {data.get('model_name')}" if data.get("model_id", 0) else ""
+        model_part = f" {escape(data.get('model_name') or '')}" if data.get("model_id", 0) else ""
         year_to = data.get("year_to") or ""
         price_to = data.get("price_to") or "..."
         summary = (
-            f"🚘 <b>{data['brand_name']}{model_part}</b>\n"
+            f"🚘 <b>{escape(data['brand_name'])}{model_part}</b>\n"
             f"📅 {data['year_from']}-{year_to}\n"
             f"💰 {data.get('price_from', 0)}$-{price_to}\n"
-            f"📍 {data.get('region_name', '...')} | ⛽ {data.get('fuel_name', '...')} | ⚙️ {gearbox_name}"
+            f"📍 {escape(data.get('region_name', '...'))} | ⛽ {data.get('fuel_name', '...')} | ⚙️ {gearbox_name}"
         )
 
-        await callback.message.answer(f"🎉 <b>Підписку збережено!</b>\n\n{summary}", reply_markup=main_menu, parse_mode="HTML")
+        await callback.message.answer(f"🎉 <b>Підписку збережено!</b>\n\n{summary}", reply_markup=main_menu)
     except Exception as e:
-        await callback.message.answer(f"❌ Помилка БД: {e}")
+        await callback.message.answer(f"❌ Помилка БД: {escape(str(e))}")
 
     await state.clear()
     await callback.answer()
@@ -390,11 +412,11 @@ async def show_subs(message: types.Message, repo: DatabaseRepo):
 
     txt = "<b>📋 Твої пошуки:</b>\n\n"
     for r in rows:
-        model_part = f" {r['model_name']}" if r.get("model_name") else ""
-        txt += f"🔹 <b>{r['brand']}{model_part}</b> ({r.get('year_from') or ''}+)\n"
+        model_part = f" {escape(r['model_name'])}" if r.get("model_name") else ""
+        txt += f"🔹 <b>{escape(r['brand'])}{model_part}</b> ({r.get('year_from') or ''}+)\n"
         txt += f"❌ /del_{r['id']}\n\n"
 
-    await message.answer(txt, parse_mode="HTML")
+    await message.answer(txt)
 
 
 @user_router.message(F.text.startswith("/del_"))
@@ -22,12 +22,14 @@ main_menu = ReplyKeyboardMarkup(
     persistent=True,
 )
 
+_SKIP_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="➡️ Пропустити")]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
 def get_skip_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="➡️ Пропустити")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+    return _SKIP_KB
 
 # -----------------------------
 # Inline keyboards helpers
@@ -123,41 +125,45 @@ def build_regions_keyboard(regions: List[Dict], *, page: int = 0) -> InlineKeybo
         skip_callback="region:0",
     )
 
-def get_fuel_keyboard() -> InlineKeyboardMarkup:
-    fuels = [
+# Fuel and gearbox keyboards depend only on constants, so they are built once
+
+_FUEL_KB = build_paged_inline_keyboard(
+    [
         {"name": "Бензин", "id": 1},
         {"name": "Дизель", "id": 2},
         {"name": "Газ", "id": 3},
         {"name": "Газ/Бензин", "id": 4},
         {"name": "Гібрид", "id": 5},
         {"name": "Електро", "id": 6},
-    ]
-    return build_paged_inline_keyboard(
-        fuels,
-        "fuel",
-        page=0,
-        per_page=50,
-        cols=2,
-        include_skip=True,
-        skip_text="➡️ Пропустити (Будь-яке)",
-        skip_callback="fuel:0",
-    )
-
+    ],
+    "fuel",
+    page=0,
+    per_page=50,
+    cols=2,
+    include_skip=True,
+    skip_text="➡️ Пропустити (Будь-яке)",
+    skip_callback="fuel:0",
+)
 
-def get_gearbox_keyboard() -> InlineKeyboardMarkup:
-    gearboxes = [
+_GEAR_KB = build_paged_inline_keyboard(
+    [
         {"name": "Ручна", "id": 1},
         {"name": "Автомат", "id": 2},
         {"name": "Робот", "id": 4},
         {"name": "Варіатор", "id": 5},
-    ]
-    return build_paged_inline_keyboard(
-        gearboxes,
-        "gear",
-        page=0,
-        per_page=50,
-        cols=2,
-        include_skip=True,
-        skip_text="➡️ Пропустити (Будь-яка)",
-        skip_callback="gear:0",
-    )
\ No newline at end of file
+    ],
+    "gear",
+    page=0,
+    per_page=50,
+    cols=2,
+    include_skip=True,
+    skip_text="➡️ Пропустити (Будь-яка)",
+    skip_callback="gear:0",
+)
+
+def get_fuel_keyboard() -> InlineKeyboardMarkup:
+    return _FUEL_KB
+
+
+def get_gearbox_keyboard() -> InlineKeyboardMarkup:
+    return _GEAR_KB
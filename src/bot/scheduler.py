@@ -1,153 +1,368 @@
 import asyncio
 import logging
+import time
+from collections import defaultdict
+from html import escape
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
 from aiogram import Bot
-from asyncpg import Pool
+from aiogram.enums import ChatAction
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import InputMediaPhoto
+from aiolimiter import AsyncLimiter
+from asyncpg import Pool, Record
+from cachetools import TTLCache
 
-from src.parser.scraper import AutoRiaScraper
+from src.parser.scraper import AutoRiaScraper, CarDTO
 from src.database.repository import DatabaseRepo
 
 logger = logging.getLogger(__name__)
 
-# Limits simultaneous requests to AutoRia to avoid 429 Too Many Requests errors
+# Number of scheduler workers, i.e. simultaneous requests to AutoRia
+# (kept low to avoid 429 Too Many Requests errors)
 MAX_CONCURRENCY = 5
 
-async def process_search(search: dict, bot: Bot, db_pool: Pool, scraper: AutoRiaScraper, semaphore: asyncio.Semaphore):
+# Cycles start every 10 min; the pause between them shrinks as cycles get longer
+CYCLE_INTERVAL = 600
+MIN_CYCLE_SLEEP = 60
+
+# A cycle must finish before the next 10-min tick, otherwise it is cancelled
+CYCLE_TIMEOUT = 540
+
+# Subscriptions with identical filters share one AutoRia request
+SEARCH_KEY_FIELDS = (
+    "brand_id", "model_id", "year_from", "year_to",
+    "price_from", "price_to", "region_id", "fuel_id", "gearbox_id",
+)
+
+# Telegram limits: up to 10 photos per media group, 4096 chars per message
+MEDIA_GROUP_SIZE = 10
+TEXT_BATCH_LIMIT = 3800
+
+# Batches bigger than this are sent without a notification sound
+SILENT_BATCH_SIZE = 5
+
+# Telegram flood limits: ~30 messages/sec overall and ~1 message/sec per chat
+_global_limiter = AsyncLimiter(30, 1)
+# Per-chat limiters are only needed while a chat is being notified; idle ones expire
+_chat_limiters: TTLCache = TTLCache(maxsize=10_000, ttl=CYCLE_INTERVAL)
+SEND_ATTEMPTS = 3
+
+# Send errors worth retrying on the next cycle; anything else is permanent
+# (bad photo URL, bot blocked by the user...) and is not retried
+_TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, TelegramRetryAfter, asyncio.TimeoutError)
+
+
+async def _send_throttled(user_id: int, send: Callable[[], Awaitable[Any]]) -> None:
+    """
+    Performs a Telegram API call within the global and per-chat rate limits.
+    If Telegram still answers with 429, waits the requested `retry_after` and retries.
+    """
+    chat_limiter = _chat_limiters.get(user_id)
+    if chat_limiter is None:
+        chat_limiter = _chat_limiters[user_id] = AsyncLimiter(1, 1)
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            async with chat_limiter:
+                async with _global_limiter:
+                    await send()
+            return
+        except TelegramRetryAfter as e:
+            if attempt == SEND_ATTEMPTS:
+                raise
+            logger.warning(f"Flood limit for user {user_id}, retrying in {e.retry_after} s")
+            await asyncio.sleep(e.retry_after)
+
+
+def _format_car(car: CarDTO) -> str:
+    """Renders the notification text; scraped fields are HTML-escaped (bot default parse_mode is HTML)."""
+    return (
+        f"🚗 <b>{escape(car.title)}</b>\n"
+        f"💰 <b>{car.price_usd} $</b>\n\n"
+        f"📏 {car.mileage} тис. км\n"
+        f"📍 {escape(car.location)}\n"
+        f"⚙️ {escape(car.gearbox)} | ⛽ {escape(car.fuel)}\n\n"
+        f"🔗 <a href='{escape(car.url)}'>Відкрити оголошення</a>"
+    )
+
+
+async def _send_single_photo(bot: Bot, user_id: int, image_url: str, msg: str, silent: bool) -> None:
+    """Sends one car with its photo; if Telegram rejects the photo, sends the text alone."""
+    try:
+        await _send_throttled(user_id, lambda: bot.send_photo(
+            user_id, photo=image_url, caption=msg, disable_notification=silent
+        ))
+    except TelegramBadRequest as e:
+        logger.warning(f"Photo rejected for user {user_id} ({image_url}): {e}. Sending text only.")
+        await _send_throttled(user_id, lambda: bot.send_message(
+            user_id, msg, disable_notification=silent
+        ))
+
+
+def _note_failure(e: Exception, user_id: int, ids: List[int], failed: List[int]) -> bool:
+    """
+    Logs a failed send. Cars of transient failures are added to `failed` so they are
+    un-marked and retried next cycle; after a permanent error they stay marked as seen.
+    Returns True if the chat is unreachable and the remaining sends should be skipped.
+    """
+    if isinstance(e, _TRANSIENT_ERRORS):
+        logger.warning(f"Temporary failure sending {len(ids)} cars to user {user_id}, will retry: {e}")
+        failed.extend(ids)
+        return False
+    if isinstance(e, TelegramForbiddenError):
+        logger.warning(f"User {user_id} is unreachable, skipping the remaining cars: {e}")
+        return True
+    logger.error(f"Dropping {len(ids)} cars for user {user_id} after a permanent error: {e}")
+    return False
+
+
+async def notify_user(bot: Bot, user_id: int, cars: List[CarDTO]) -> List[int]:
+    """
+    Sends new cars to the user in as few API calls as possible:
+    - cars with photos are grouped into media groups (up to 10 per call);
+    - cars without photos are concatenated into long text messages.
+    Large batches are delivered silently to avoid buzzing the user.
+    Returns:
+        IDs of cars that could not be delivered because of a transient error.
+    """
+    # Render everything up front, the loops below only do I/O
+    payloads = [(car.id, car.image_url, _format_car(car)) for car in cars]
+    with_photo = [(car_id, image_url, msg) for car_id, image_url, msg in payloads if image_url]
+    text_only = [(car_id, msg) for car_id, image_url, msg in payloads if not image_url]
+    silent = len(payloads) > SILENT_BATCH_SIZE
+    failed: List[int] = []
+
+    if with_photo:
+        try:
+            await bot.send_chat_action(user_id, ChatAction.UPLOAD_PHOTO)
+        except Exception as e:
+            logger.debug(f"Failed to send chat action to user {user_id}: {e}")
+
+    for i in range(0, len(with_photo), MEDIA_GROUP_SIZE):
+        chunk = with_photo[i : i + MEDIA_GROUP_SIZE]
+        # sendMediaGroup requires at least 2 items
+        if len(chunk) > 1:
+            media = [
+                InputMediaPhoto(media=image_url, caption=msg)
+                for _, image_url, msg in chunk
+            ]
+            try:
+                await _send_throttled(user_id, lambda: bot.send_media_group(
+                    user_id, media=media, disable_notification=silent
+                ))
+                continue
+            except TelegramBadRequest as e:
+                # Usually one bad photo URL rejects the whole group: fall back to one by one
+                logger.warning(f"Media group rejected for user {user_id}: {e}. Sending items one by one.")
+            except Exception as e:
+                if _note_failure(e, user_id, [car_id for car_id, _, _ in chunk], failed):
+                    return failed
+                continue
+
+        for car_id, image_url, msg in chunk:
+            try:
+                await _send_single_photo(bot, user_id, image_url, msg, silent)
+            except Exception as e:
+                if _note_failure(e, user_id, [car_id], failed):
+                    return failed
+
+    # Each batch is (text, car IDs included in it)
+    batches: List[Tuple[str, List[int]]] = []
+    for car_id, msg in text_only:
+        if batches and len(batches[-1][0]) + len(msg) + 2 <= TEXT_BATCH_LIMIT:
+            text, ids = batches[-1]
+            batches[-1] = (text + "\n\n" + msg, ids + [car_id])
+        else:
+            batches.append((msg, [car_id]))
+
+    for text, ids in batches:
+        try:
+            await _send_throttled(user_id, lambda: bot.send_message(
+                user_id, text, disable_web_page_preview=False, disable_notification=silent
+            ))
+        except Exception as e:
+            if _note_failure(e, user_id, ids, failed):
+                return failed
+
+    return failed
+
+
+def _search_key(search: Record) -> Tuple[int, ...]:
+    """Builds the filter tuple that identifies an AutoRia request."""
+    return tuple(int(search.get(field) or 0) for field in SEARCH_KEY_FIELDS)
+
+
+async def _fetch_cars(key: Tuple[int, ...], scraper: AutoRiaScraper) -> List[CarDTO]:
+    """Performs the HTTP request to AutoRia for a filter tuple."""
+    return await scraper.search_cars(**dict(zip(SEARCH_KEY_FIELDS, key)))
+
+
+def _match_model(search: Record, found_cars: List[CarDTO]) -> List[CarDTO]:
     """
-    Processes a single search subscription:
-    1. Acquires a semaphore slot (rate limiting).
-    2. Performs the HTTP request to AutoRia.
-    3. Filters results (name check).
-    4. Saves new items to DB and notifies the user.
+    SAFETY CATCH: Name-based Filtering.
+    Sometimes API returns unrelated cars if ID is invalid.
+    We double-check if the model name exists in the car title.
     """
+    target_model = search.get("model_name")
+
+    if target_model and target_model not in ["Будь-яка", "Всі моделі"]:
+        target = target_model.lower()
+        return [car for car in found_cars if target in car.title.lower()]
+    return found_cars
+
+
+async def deliver(search: Record, new_cars: List[CarDTO], bot: Bot, repo: DatabaseRepo):
+    """Notifies the user about new cars and un-marks the ones that failed transiently."""
     user_id = search["user_id"]
-    brand_name = search["brand"]
-    
-    # Rate limiting block
-    async with semaphore:
+
+    failed_ids = await notify_user(bot, user_id, new_cars)
+    logger.info(f"User {user_id}: sent {len(new_cars) - len(failed_ids)} new cars ({search['brand']})")
+
+    if failed_ids:
+        # Roll back the cars that hit a transient error so they are retried on the next cycle
         try:
-            found_cars = await scraper.search_cars(
-                brand_id=int(search.get("brand_id") or 0),
-                model_id=int(search.get("model_id") or 0),
-                year_from=int(search.get("year_from") or 0),
-                year_to=int(search.get("year_to") or 0),
-                price_from=int(search.get("price_from") or 0),
-                price_to=int(search.get("price_to") or 0),
-                region_id=int(search.get("region_id") or 0),
-                fuel_id=int(search.get("fuel_id") or 0),
-                gearbox_id=int(search.get("gearbox_id") or 0),
-            )
+            await repo.unmark_seen_bulk(user_id, failed_ids)
         except Exception as e:
-            logger.error(f"Error scraping for user {user_id}: {e}")
-            return
+            logger.error(f"DB/Logic error for user {user_id}: {e}")
+
+
+async def process_group(key: Tuple[int, ...], searches: List[Record], bot: Bot, db_pool: Pool, scraper: AutoRiaScraper):
+    """
+    Fetches cars once for a filter tuple and fans them out to every subscriber:
+    1. Filters results per subscription (name check).
+    2. Marks new cars as seen for all subscribers in one transaction.
+    3. Notifies each user in batches (after the connection is released).
+    """
+    try:
+        found_cars = await _fetch_cars(key, scraper)
+    except Exception as e:
+        logger.error(f"Error scraping for filters {key}: {e}")
+        return
 
     if not found_cars:
         return
-    
-    # --- SAFETY CATCH: Name-based Filtering ---
-    # Sometimes API returns unrelated cars if ID is invalid.
-    # We double-check if the model name exists in the car title.
-    target_model = search.get("model_name")
-    filtered_cars = []
 
-    if target_model and target_model not in ["Будь-яка", "Всі моделі"]:
-        for car in found_cars:
-            if target_model.lower() in car.title.lower():
-                filtered_cars.append(car)
-            else:
-                # Debug log: filtered out unrelated car
-                pass
-        
-        found_cars = filtered_cars
-        
-        if not found_cars:
-            return
+    # Cars are marked as seen before sending; only the rows actually inserted are
+    # returned, so overlapping subscriptions of the same user processed
+    # concurrently do not deliver the same car twice.
+    repo = DatabaseRepo(db_pool)
+    pending: List[Tuple[Record, List[CarDTO]]] = []
 
-    # Database operations and Notification logic
-    # (No semaphore here, as DB is fast and has its own pool)
-    new_cars_count = 0
-    
     try:
-        async with db_pool.acquire() as conn:
-            repo = DatabaseRepo(conn)
-            for car in found_cars:
-                # Check if user has already seen this car
-                is_seen = await repo.is_car_seen(user_id, car.id)
-                if is_seen:
+        # One connection and one commit for the whole group instead of one per subscriber.
+        # Row locks are taken in (user_id, car_id) order in every group, so concurrent
+        # groups sharing users and cars wait on each other instead of deadlocking.
+        async with repo.transaction() as tx:
+            for search in sorted(searches, key=lambda s: s["user_id"]):
+                cars = _match_model(search, found_cars)
+                if not cars:
                     continue
-                
-                new_cars_count += 1
-                
-                # Construct message
-                msg = (
-                    f"🚗 <b>{car.title}</b>\n"
-                    f"💰 <b>{car.price_usd} $</b>\n\n"
-                    f"📏 {car.mileage} тис. км\n"
-                    f"📍 {car.location}\n"
-                    f"⚙️ {car.gearbox} | ⛽ {car.fuel}\n\n"
-                    f"🔗 <a href='{car.url}'>Відкрити оголошення</a>"
-                )
-
-                try:
-                    if car.image_url:
-                        await bot.send_photo(user_id, photo=car.image_url, caption=msg, parse_mode="HTML")
-                    else:
-                        await bot.send_message(user_id, msg, parse_mode="HTML", disable_web_page_preview=False)
-                    
-                    # Small delay to avoid Telegram flood limits
-                    await asyncio.sleep(0.5)
-                except Exception as e:
-                    logger.error(f"Failed to send message to user {user_id}: {e}")
-
-        if new_cars_count > 0:
-            logger.info(f"User {user_id}: sent {new_cars_count} new cars ({brand_name})")
-            
+                new_ids = await tx.filter_new_cars(search["user_id"], [car.id for car in cars])
+                new_cars = [car for car in cars if car.id in new_ids]
+                if new_cars:
+                    pending.append((search, new_cars))
     except Exception as e:
-        logger.error(f"DB/Logic error for user {user_id}: {e}")
+        logger.error(f"DB/Logic error for filters {key}: {e}")
+        return
+
+    delivered = 0
+    try:
+        for search, new_cars in pending:
+            await deliver(search, new_cars, bot, repo)
+            delivered += 1
+    except asyncio.CancelledError:
+        # The cycle timed out after the seen-marks were committed: un-mark the cars not
+        # (fully) sent yet so the next cycle retries them rather than losing them
+        for search, new_cars in pending[delivered:]:
+            try:
+                await repo.unmark_seen_bulk(search["user_id"], [car.id for car in new_cars])
+            except Exception as e:
+                logger.error(f"DB/Logic error for user {search['user_id']}: {e}")
+        raise
+
+
+async def _worker(queue: asyncio.Queue, bot: Bot, db_pool: Pool, scraper: AutoRiaScraper):
+    """Consumes search groups from the queue until it receives the `None` sentinel."""
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            key, searches = item
+            await process_group(key, searches, bot, db_pool, scraper)
+        except Exception as e:
+            logger.error(f"Unexpected error in search group {item[0]}: {e}")
+        finally:
+            queue.task_done()
 
 
-async def check_new_cars(bot: Bot, db_pool: Pool):
+async def check_new_cars(bot: Bot, db_pool: Pool, scraper: AutoRiaScraper):
     """
-    Main cycle function. Launches search tasks in parallel groups.
+    Main cycle function. Searches are grouped by their filters, and a fixed pool
+    of MAX_CONCURRENCY workers processes the groups from a queue, so concurrency
+    is bounded structurally. A stuck cycle is cancelled after CYCLE_TIMEOUT.
     """
-    scraper = AutoRiaScraper()
-    
+    try:
+        async with asyncio.timeout(CYCLE_TIMEOUT):
+            await _run_cycle(bot, db_pool, scraper)
+    except TimeoutError:
+        logger.warning(f"Scheduler: cycle exceeded {CYCLE_TIMEOUT} s and was cancelled.")
+
+
+async def _run_cycle(bot: Bot, db_pool: Pool, scraper: AutoRiaScraper):
     # 1. Fetch all active subscriptions
-    async with db_pool.acquire() as conn:
-        repo = DatabaseRepo(conn)
-        searches = await repo.get_active_searches()
+    searches = await DatabaseRepo(db_pool).get_active_searches()
 
     if not searches:
         return
 
-    logger.info(f"Scheduler: checking {len(searches)} active searches...")
-    
-    # 2. Create tasks with semaphore
-    sem = asyncio.Semaphore(MAX_CONCURRENCY)
-    tasks = []
-    
+    groups: Dict[Tuple[int, ...], List[Record]] = defaultdict(list)
     for search in searches:
-        task = asyncio.create_task(
-            process_search(search, bot, db_pool, scraper, sem)
-        )
-        tasks.append(task)
+        groups[_search_key(search)].append(search)
+
+    logger.info(f"Scheduler: checking {len(searches)} active searches ({len(groups)} unique filters)...")
     
-    # 3. Wait for all tasks to complete
-    await asyncio.gather(*tasks)
+    # 2. Fill the queue, one sentinel per worker marks the end of work
+    queue: asyncio.Queue = asyncio.Queue()
+    for group in groups.items():
+        queue.put_nowait(group)
+    for _ in range(MAX_CONCURRENCY):
+        queue.put_nowait(None)
+
+    # 3. Run the workers until the queue is drained
+    # (TaskGroup cancels the remaining workers if one of them crashes)
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(MAX_CONCURRENCY):
+            tg.create_task(_worker(queue, bot, db_pool, scraper))
     
     logger.info("Scheduler: cycle finished.")
 
 
-async def start_scheduler(bot: Bot, db_pool: Pool):
-    logger.info("Scheduler started (interval: 10 min)")
+async def start_scheduler(bot: Bot, db_pool: Pool, scraper: AutoRiaScraper):
+    logger.info(f"Scheduler started (interval: {CYCLE_INTERVAL // 60} min)")
     
     # Warm-up delay
     await asyncio.sleep(10)
     
     while True:
+        started = time.monotonic()
         try:
-            await check_new_cars(bot, db_pool)
+            await check_new_cars(bot, db_pool, scraper)
         except Exception as e:
             logger.error(f"Critical scheduler error: {e}")
 
-        logger.info("Sleeping for 10 min...")
-        await asyncio.sleep(600)
\ No newline at end of file
+        # Keep a steady cadence: subtract the time the cycle itself took
+        elapsed = time.monotonic() - started
+        if elapsed >= CYCLE_INTERVAL:
+            logger.warning(f"Scheduler is falling behind: cycle took {elapsed:.0f} s")
+            continue
+
+        delay = max(MIN_CYCLE_SLEEP, CYCLE_INTERVAL - elapsed)
+        logger.info(f"Cycle took {elapsed:.0f} s, sleeping for {delay:.0f} s...")
+        await asyncio.sleep(delay)
\ No newline at end of file
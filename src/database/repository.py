@@ -1,44 +1,55 @@
-from typing import List, Optional, Any
-from asyncpg import Connection
-from dataclasses import dataclass
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Any, Set
+from asyncpg import Connection, Pool, Record
 
-@dataclass
-class SearchRecord:
-    id: int
-    user_id: int
-    brand: str
-    brand_id: int
-    model_name: Optional[str]
-    model_id: int
-    year_from: int
-    year_to: int
-    price_from: int
-    price_to: int
-    region_id: int
-    fuel_id: int
-    gearbox_id: int
-    status: str
+# Integer FSM fields stored on a subscription, in INSERT column order
+_INT_KEYS = (
+    "brand_id", "model_id", "year_from", "year_to",
+    "price_from", "price_to", "region_id", "fuel_id", "gearbox_id",
+)
 
 class DatabaseRepo:
     """
     Repository pattern implementation for database operations.
     Abstracts raw SQL queries from business logic.
+
+    Every method acquires a connection from the pool only for the duration of
+    its query, so concurrent handlers never queue behind a single connection.
+    Use `transaction()` to run several calls on one connection with one commit.
     """
-    def __init__(self, conn: Connection):
-        self.conn = conn
+    def __init__(self, pool: Pool, conn: Optional[Connection] = None):
+        self.pool = pool
+        self._conn = conn
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[Connection]:
+        """Yields the connection bound by `transaction()`, or a pooled one for a single query."""
+        if self._conn is not None:
+            yield self._conn
+        else:
+            async with self.pool.acquire() as conn:
+                yield conn
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["DatabaseRepo"]:
+        """Yields a repository whose calls share one connection and commit together."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield DatabaseRepo(self.pool, conn)
 
     # --- Users ---
     async def add_user(self, user_id: int, username: str, full_name: str):
         """Creates or updates a user record."""
-        await self.conn.execute(
-            """
-            INSERT INTO users (user_id, username, full_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) DO UPDATE 
-            SET username = EXCLUDED.username, full_name = EXCLUDED.full_name
-            """,
-            user_id, username, full_name
-        )
+        async with self._acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO users (user_id, username, full_name)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO UPDATE 
+                SET username = EXCLUDED.username, full_name = EXCLUDED.full_name
+                """,
+                user_id, username, full_name
+            )
 
     # --- Searches (Subscriptions) ---
     async def add_search(self, user_id: int, data: dict):
@@ -48,59 +59,79 @@ class DatabaseRepo:
             user_id: Telegram user ID.
             data: Dictionary containing FSM state data.
         """
-        await self.conn.execute(
-            """
-            INSERT INTO searches
-            (user_id, brand, brand_id, model_name, model_id, year_from, year_to, 
-             price_from, price_to, region_id, fuel_id, gearbox_id, status)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, 'active')
-            """,
-            user_id,
-            data["brand_name"],
-            int(data.get("brand_id", 0)),
-            data.get("model_name"),
-            int(data.get("model_id", 0)),
-            int(data.get("year_from", 0)),
-            int(data.get("year_to", 0)),
-            int(data.get("price_from", 0)),
-            int(data.get("price_to", 0)),
-            int(data.get("region_id", 0)),
-            int(data.get("fuel_id", 0)),
-            int(data.get("gearbox_id", 0)),
-        )
+        args = [int(data.get(k, 0) or 0) for k in _INT_KEYS]
+        async with self._acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO searches
+                (user_id, brand, model_name, brand_id, model_id, year_from, year_to, 
+                 price_from, price_to, region_id, fuel_id, gearbox_id, status)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, 'active')
+                """,
+                user_id, data["brand_name"], data.get("model_name"), *args
+            )
 
-    async def get_active_searches(self) -> List[dict]:
-        """Fetches all active subscriptions for the scheduler."""
-        rows = await self.conn.fetch("SELECT * FROM searches WHERE status = 'active'")
+    async def get_active_searches(self) -> List[Record]:
+        """
+        Fetches all active subscriptions for the scheduler.
+        Only the columns the scheduler reads are selected; the statement text is
+        constant, so asyncpg's per-connection statement cache reuses the prepared plan.
+        """
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT id, user_id, brand, brand_id, model_name, model_id,
+                       year_from, year_to, price_from, price_to,
+                       region_id, fuel_id, gearbox_id
+                FROM searches WHERE status = 'active'
+                """
+            )
         return rows
 
-    async def get_user_searches(self, user_id: int) -> List[dict]:
+    async def get_user_searches(self, user_id: int) -> List[Record]:
         """Fetches active subscriptions for a specific user."""
-        return await self.conn.fetch(
-            "SELECT id, brand, model_name, year_from, status FROM searches WHERE user_id=$1 AND status='active' ORDER BY id DESC",
-            user_id
-        )
+        async with self._acquire() as conn:
+            return await conn.fetch(
+                "SELECT id, brand, model_name, year_from FROM searches WHERE user_id=$1 AND status='active' ORDER BY id DESC",
+                user_id
+            )
 
     async def delete_search(self, search_id: int, user_id: int):
-        """Deletes (or deactivates) a subscription."""
-        await self.conn.execute("DELETE FROM searches WHERE id=$1 AND user_id=$2", search_id, user_id)
+        """
+        Deactivates a subscription (soft delete).
+        The row drops out of the partial `status = 'active'` indexes and scheduler scans.
+        """
+        async with self._acquire() as conn:
+            await conn.execute(
+                "UPDATE searches SET status='deleted' WHERE id=$1 AND user_id=$2 AND status='active'",
+                search_id, user_id
+            )
 
     # --- Seen Cars ---
-    async def is_car_seen(self, user_id: int, car_id: int) -> bool:
+    async def filter_new_cars(self, user_id: int, car_ids: List[int]) -> Set[int]:
         """
-        Checks if a user has already received a specific car.
-        Returns:
-            True if car was already seen.
-            False if it's new (and inserts it as seen).
+        Marks a batch of cars as seen and returns the IDs that were not seen before.
+        A single INSERT ... RETURNING replaces the separate lookup and insert.
+        IDs are inserted in ascending order (unnest keeps array order), so concurrent
+        transactions lock conflicting rows in the same order.
         """
-        res = await self.conn.execute(
-            """
-            INSERT INTO seen_cars (user_id, car_id)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id, car_id) DO NOTHING
-            """,
-            user_id, int(car_id)
-        )
-        # 'INSERT 0 1' means row was inserted (New car) -> Return False
-        # 'INSERT 0 0' means conflict/duplicate (Seen car) -> Return True
-        return res != "INSERT 0 1"
\ No newline at end of file
+        car_ids = sorted(car_ids)
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                """
+                INSERT INTO seen_cars (user_id, car_id)
+                SELECT $1, c FROM unnest($2::bigint[]) AS t(c)
+                ON CONFLICT (user_id, car_id) DO NOTHING
+                RETURNING car_id
+                """,
+                user_id, car_ids
+            )
+        return {r["car_id"] for r in rows}
+
+    async def unmark_seen_bulk(self, user_id: int, car_ids: List[int]):
+        """Reverts `filter_new_cars` for cars that could not be delivered."""
+        async with self._acquire() as conn:
+            await conn.execute(
+                "DELETE FROM seen_cars WHERE user_id=$1 AND car_id = ANY($2::bigint[])",
+                user_id, car_ids
+            )
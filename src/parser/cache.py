@@ -0,0 +1,81 @@
+"""
+In-process TTL cache for AutoRia reference data (Brands, Models, Regions).
+
+Subscription flows are served from memory instead of hitting the AutoRia API
+on every step. Concurrent misses for the same key are collapsed into a single
+upstream request (single-flight).
+
+Each entry is stored as (items, id_to_name) so handlers resolve names in O(1).
+Models additionally keep their lower-cased names for the text search.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from cachetools import TTLCache
+
+from src.parser.scraper import AutoRiaScraper
+
+# Time-To-Live in seconds
+BRANDS_TTL = 3600
+REGIONS_TTL = 3600
+MODELS_TTL = 24 * 3600
+
+_brands_cache: TTLCache = TTLCache(maxsize=1, ttl=BRANDS_TTL)
+_regions_cache: TTLCache = TTLCache(maxsize=1, ttl=REGIONS_TTL)
+_models_cache: TTLCache = TTLCache(maxsize=1024, ttl=MODELS_TTL)
+
+_locks: Dict[Hashable, asyncio.Lock] = {}
+
+CatalogEntry = Tuple[List[Dict], Dict[int, str]]
+ModelsEntry = Tuple[List[Dict], Dict[int, str], List[str]]
+
+
+def _index(items: List[Dict]) -> CatalogEntry:
+    """Precomputes the id -> name lookup once per fetch."""
+    return items, {int(it["id"]): str(it["name"]) for it in items}
+
+
+def _index_models(items: List[Dict]) -> ModelsEntry:
+    """Like `_index`, plus names lower-cased once (parallel to `items`) for substring search."""
+    items, id_to_name = _index(items)
+    return items, id_to_name, [str(it.get("name", "")).lower() for it in items]
+
+
+async def _get_or_fetch(
+    cache: TTLCache,
+    key: Hashable,
+    fetch: Callable[[], Awaitable[List[Dict]]],
+    index: Callable[[List[Dict]], Any] = _index,
+) -> Any:
+    """Returns a cached value or fetches it, letting only one caller per key hit the API."""
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock = _locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Another coroutine may have filled the cache while we were waiting
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+        items = await fetch()
+        value = index(items)
+        # Empty results usually mean an API error, so they are not cached
+        if items:
+            cache[key] = value
+        return value
+
+
+async def get_brands_cached(scraper: AutoRiaScraper) -> CatalogEntry:
+    return await _get_or_fetch(_brands_cache, "brands", scraper.get_brands)
+
+
+async def get_regions_cached(scraper: AutoRiaScraper) -> CatalogEntry:
+    return await _get_or_fetch(_regions_cache, "regions", scraper.get_states)
+
+
+async def get_models_cached(scraper: AutoRiaScraper, brand_id: int) -> ModelsEntry:
+    return await _get_or_fetch(
+        _models_cache, ("models", brand_id), lambda: scraper.get_models(brand_id), _index_models
+    )
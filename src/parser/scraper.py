@@ -1,15 +1,54 @@
 import asyncio
 import aiohttp
-import logging
 import json
+import logging
+import orjson
 import re
-import time
-from typing import List, Dict, Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from dataclasses import dataclass
-from urllib.parse import urlparse
+from functools import lru_cache
+
+from redis.asyncio import Redis
 
 logger = logging.getLogger(__name__)
 
+_JSON_DECODER = json.JSONDecoder()
+_IMG_URL_RE = re.compile(r"^https?://.+\.(jpg|jpeg|png|webp)(\?.*)?$", re.IGNORECASE)
+
+# basicInfo icon tag -> CarDTO field, checked in order (first match wins)
+_ICON_FIELDS = (
+    ("speedometer", "mileage"),
+    ("location", "location"),
+    ("automat", "gearbox"),
+    ("transmission", "gearbox"),
+    ("fuel", "fuel"),
+)
+
+
+# Known locations of the ads list in the Pinia state, tried before walking the whole tree
+_PINIA_OFFER_PATHS = (
+    ("searchPage", "result"),
+    ("searchPage", "offers"),
+    ("searchResults", "items"),
+)
+
+
+def _is_car_ad(obj: Dict[str, Any]) -> bool:
+    """Heuristic: verify if object looks like a car ad."""
+    return ("id" in obj and "price" in obj and "USD" in str(obj["price"])
+            and ("basicInfo" in obj or "title" in obj))
+
+
+def _first_number(txt: str) -> int:
+    """Returns the first run of digits in `txt`, ignoring spaces ("1 500 тис. км" -> 1500)."""
+    digits = []
+    for ch in txt:
+        if ch.isdecimal():
+            digits.append(ch)
+        elif digits and ch != " ":
+            break
+    return int("".join(digits)) if digits else 0
+
 
 @dataclass
 class CarDTO:
@@ -30,9 +69,11 @@ class AutoRiaScraper:
     Scraper for Auto.ria.com using asynchronous requests.
     
     Features:
-    - RAM Caching for static data (Brands, Models, States) to reduce API load.
-    - Robust HTML parsing using Regex (fallback mechanism for Nuxt/Pinia states).
+    - Optional Redis persistence for static data (Brands, Models, States), so it
+      survives restarts (in-memory TTL caching lives in `src.parser.cache`).
+    - Robust HTML parsing of the embedded Pinia/Nuxt state (with Nuxt as fallback).
     - Concurrent enrichment of car details.
+    - A single keep-alive HTTP session shared by all requests.
     """
 
     BASE_SEARCH_URL = "https://auto.ria.com/uk/search/"
@@ -41,19 +82,11 @@ class AutoRiaScraper:
     STATES_URL = "https://auto.ria.com/api/states"
     FINAL_PAGE_URL = "https://auto.ria.com/bff/final-page/public/{car_id}"
 
-    # --- In-Memory Cache (Class Level) ---
-    _brands_cache: List[Dict] = []
-    _brands_last_update: float = 0
-    
-    _states_cache: List[Dict] = []
-    _states_last_update: float = 0
-    
-    _models_cache: Dict[int, List[Dict]] = {}
-    
-    # Cache Time-To-Live in seconds (1 hour)
+    # Redis Time-To-Live in seconds (same as the in-memory TTLs in `src.parser.cache`)
     CACHE_TTL = 3600
+    MODELS_CACHE_TTL = 24 * 3600
 
-    def __init__(self):
+    def __init__(self, max_connections: int = 10, max_connections_per_host: int = 8, redis: Optional[Redis] = None):
         self.headers = {
             "User-Agent": (
                 "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -63,88 +96,137 @@ class AutoRiaScraper:
             "Accept": "application/json, text/plain, */*",
             "Accept-Language": "uk-UA,uk;q=0.9,en-US;q=0.8,en;q=0.7",
         }
+        # Overrides for the search page to mimic a browser; merged over the session headers
+        self._html_headers = {
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Upgrade-Insecure-Requests": "1",
+        }
         self._details_concurrency = 6
         self._details_timeout_sec = 20
+        self._max_connections = max_connections
+        self._max_connections_per_host = max_connections_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._redis = redis
 
-    async def get_brands(self) -> List[Dict]:
+    async def _get_session(self) -> aiohttp.ClientSession:
         """
-        Fetches the list of car brands. 
-        Uses in-memory cache if available and fresh.
+        Returns the shared HTTP session, creating it on first use.
+        Keeps TCP/TLS connections alive between requests.
         """
-        now = time.time()
-        if self._brands_cache and (now - self._brands_last_update < self.CACHE_TTL):
-            return self._brands_cache
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._max_connections,
+                limit_per_host=self._max_connections_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        return self._session
+
+    async def close(self):
+        """Closes the shared HTTP session (call on shutdown)."""
+        if self._session and not self._session.closed:
+            await self._session.close()
 
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            try:
-                async with session.get(self.BRANDS_URL, timeout=15) as r:
-                    if r.status != 200:
-                        logger.warning(f"Failed to fetch brands. Status: {r.status}")
-                        return []
-                    data = await r.json(content_type=None)
-                    
-                    # Normalize data
-                    out = []
-                    for item in data:
-                        name = item.get("name")
-                        val = item.get("value", item.get("id"))
-                        if name and val:
-                            out.append({"name": name, "id": int(val)})
+    @staticmethod
+    async def _json(r: aiohttp.ClientResponse) -> Any:
+        """Decodes a JSON response body; the API always returns UTF-8, so no charset/content-type probing."""
+        return orjson.loads(await r.read())
+
+    async def _redis_get(self, key: str) -> Optional[List[Dict]]:
+        """Reads a persisted reference list; Redis errors are treated as a miss."""
+        if self._redis is None:
+            return None
+        try:
+            raw = await self._redis.get(key)
+            return orjson.loads(raw) if raw else None
+        except Exception as e:
+            logger.warning(f"Redis cache read failed for {key}: {e}")
+            return None
+
+    async def _redis_set(self, key: str, ttl: int, items: List[Dict]):
+        """Persists a non-empty reference list with a TTL."""
+        if self._redis is None or not items:
+            return
+        try:
+            await self._redis.setex(key, ttl, orjson.dumps(items))
+        except Exception as e:
+            logger.warning(f"Redis cache write failed for {key}: {e}")
+
+    async def get_brands(self) -> List[Dict]:
+        """Fetches the list of car brands (from Redis if persisted there)."""
+        cached = await self._redis_get("autoria:brands")
+        if cached is not None:
+            return cached
+
+        session = await self._get_session()
+        try:
+            async with session.get(self.BRANDS_URL, timeout=15) as r:
+                if r.status != 200:
+                    logger.warning(f"Failed to fetch brands. Status: {r.status}")
+                    return []
+                data = await self._json(r)
                     
-                    # Update cache
-                    AutoRiaScraper._brands_cache = out
-                    AutoRiaScraper._brands_last_update = now
-                    logger.info(f"Brands cache updated: {len(out)} items")
-                    return out
-            except Exception as e:
-                logger.error(f"Error fetching brands: {e}")
-                return []
+                # Normalize data
+                out = []
+                for item in data:
+                    name = item.get("name")
+                    val = item.get("value", item.get("id"))
+                    if name and val:
+                        out.append({"name": name, "id": int(val)})
+
+                logger.info(f"Brands fetched: {len(out)} items")
+            await self._redis_set("autoria:brands", self.CACHE_TTL, out)
+            return out
+        except Exception as e:
+            logger.error(f"Error fetching brands: {e}")
+            return []
             
     async def get_states(self) -> List[Dict]:
         """
         Fetches the list of regions (states).
         Uses params={'langId': 4} to get Ukrainian names.
         """
-        now = time.time()
-        if self._states_cache and (now - self._states_last_update < self.CACHE_TTL):
-            return self._states_cache
+        cached = await self._redis_get("autoria:states")
+        if cached is not None:
+            return cached
 
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            try:
-                async with session.get(self.STATES_URL, params={"langId": 4}, timeout=15) as r:
-                    if r.status != 200:
-                        logger.warning(f"Failed to fetch states. Status: {r.status}")
-                        return []
-                    data = await r.json(content_type=None)
+        session = await self._get_session()
+        try:
+            async with session.get(self.STATES_URL, params={"langId": 4}, timeout=15) as r:
+                if r.status != 200:
+                    logger.warning(f"Failed to fetch states. Status: {r.status}")
+                    return []
+                data = await self._json(r)
                     
-                    out = [{"name": i.get("name"), "id": int(i.get("value", i.get("id")))} for i in data]
-
-                    AutoRiaScraper._states_cache = out
-                    AutoRiaScraper._states_last_update = now
-                    logger.info(f"States cache updated: {len(out)} items")
-                    return out
-            except Exception as e:
-                logger.error(f"Error fetching states: {e}")
-                return []
+                out = [{"name": i.get("name"), "id": int(i.get("value", i.get("id")))} for i in data]
+                logger.info(f"States fetched: {len(out)} items")
+            await self._redis_set("autoria:states", self.CACHE_TTL, out)
+            return out
+        except Exception as e:
+            logger.error(f"Error fetching states: {e}")
+            return []
 
     async def get_models(self, brand_id: int) -> List[Dict]:
-        """Fetches models for a specific brand ID. Cached by brand_id."""
-        if brand_id in self._models_cache:
-            return self._models_cache[brand_id]
+        """Fetches models for a specific brand ID (from Redis if persisted there)."""
+        redis_key = f"autoria:models:{brand_id}"
+        cached = await self._redis_get(redis_key)
+        if cached is not None:
+            return cached
 
         url = self.MODELS_URL.format(brand_id)
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            try:
-                async with session.get(url, timeout=15) as r:
-                    if r.status != 200:
-                        return []
-                    data = await r.json(content_type=None)
-                    models = [{"name": item["name"], "id": item["value"]} for item in data]
-                    self._models_cache[brand_id] = models
-                    return models
-            except Exception as e:
-                logger.error(f"Error fetching models: {e}")
-                return []
+        session = await self._get_session()
+        try:
+            async with session.get(url, timeout=15) as r:
+                if r.status != 200:
+                    return []
+                data = await self._json(r)
+                models = [{"name": item["name"], "id": item["value"]} for item in data]
+            await self._redis_set(redis_key, self.MODELS_CACHE_TTL, models)
+            return models
+        except Exception as e:
+            logger.error(f"Error fetching models: {e}")
+            return []
 
     async def search_cars(
         self,
@@ -161,7 +243,7 @@ class AutoRiaScraper:
         """
         Main search method.
         1. Fetches the search results page (HTML).
-        2. Extracts raw JSON data using Regex.
+        2. Decodes the embedded JSON state in place.
         3. Enriches missing details via separate API calls if necessary.
         """
         params = {
@@ -182,33 +264,29 @@ class AutoRiaScraper:
         if gearbox_id: params["gearbox.id[0]"] = gearbox_id
         if fuel_id: params["fuel.id[0]"] = fuel_id
 
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            try:
-                # Mimic browser headers
-                html_headers = dict(self.headers)
-                html_headers["Accept"] = "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
-                html_headers["Upgrade-Insecure-Requests"] = "1"
-
-                async with session.get(self.BASE_SEARCH_URL, params=params, headers=html_headers, timeout=25) as r:
-                    if r.status != 200:
-                        logger.warning(f"Search page returned status: {r.status}")
-                        return []
-                    html = await r.text()
-
-                cars = self._extract_cars_from_pinia(html)
-                if not cars:
-                    # Often happens if AutoRia changes layout or blocks IP
-                    logger.warning(f"Search returned 0 cars. URL: {r.url}")
+        session = await self._get_session()
+        try:
+            async with session.get(self.BASE_SEARCH_URL, params=params, headers=self._html_headers, timeout=25) as r:
+                if r.status != 200:
+                    logger.warning(f"Search page returned status: {r.status}")
                     return []
+                html = await r.text()
 
-                # Enrich details (images, mileage, etc.)
-                cars = await self._enrich_missing_details(session, cars)
-                return cars
-
-            except Exception as e:
-                logger.error(f"Error during scraping: {e}")
+            # Parsing a ~1 MB page is CPU-bound; keep it off the event loop
+            cars = await asyncio.to_thread(self._extract_cars_from_pinia, html)
+            if not cars:
+                # Often happens if AutoRia changes layout or blocks IP
+                logger.warning(f"Search returned 0 cars. URL: {r.url}")
                 return []
 
+            # Enrich details (images, mileage, etc.)
+            cars = await self._enrich_missing_details(session, cars)
+            return cars
+
+        except Exception as e:
+            logger.error(f"Error during scraping: {e}")
+            return []
+
     # ----------------------------
     # ROBUST PINIA PARSING
     # ----------------------------
@@ -217,47 +295,33 @@ class AutoRiaScraper:
         Extracts car data from the embedded JSON state in the HTML.
         Supports both 'PINIA' (new stack) and 'NUXT' (legacy stack) formats.
         """
-        json_data = None
-        
-        # 1. Try finding PINIA state
-        pinia_match = re.search(r'window\.__PINIA__\s*=\s*(\{.*?\})\s*(?:;<|;\n|<\/script>)', html, re.DOTALL)
-        
-        if pinia_match:
-            try:
-                json_data = json.loads(pinia_match.group(1))
-            except json.JSONDecodeError:
-                logger.warning("Failed to decode PINIA JSON")
-
-        # 2. Fallback to NUXT state
-        if not json_data:
-            nuxt_match = re.search(r'window\.__NUXT__\s*=\s*(\{.*?\})\s*(?:;<|;\n|<\/script>)', html, re.DOTALL)
-            if nuxt_match:
-                try:
-                    json_data = json.loads(nuxt_match.group(1))
-                except json.JSONDecodeError:
-                    pass
+        # 1. Try finding PINIA state, 2. Fallback to NUXT state
+        json_data = (
+            self._decode_state_json(html, "window.__PINIA__")
+            or self._decode_state_json(html, "window.__NUXT__")
+        )
 
         if not json_data:
             logger.warning("Could not find PINIA or NUXT state in HTML")
             return []
 
-        # 3. Recursively find car objects within the JSON
-        found: List[Dict[str, Any]] = []
-
-        def collect(obj: Any):
-            if isinstance(obj, dict):
-                # Heuristic: verify if object looks like a car ad
-                if "id" in obj and "price" in obj and "USD" in str(obj["price"]):
-                    if "basicInfo" in obj or "title" in obj:
+        # 3. Look up the ads list at a known path first
+        found = self._find_offers_by_path(json_data)
+
+        # 4. Otherwise find car objects within the whole JSON (iterative pre-order
+        # walk; children are pushed reversed so they are visited in document order)
+        if not found:
+            logger.debug("No known Pinia offers path matched, walking the whole state")
+            stack: List[Any] = [json_data]
+            while stack:
+                obj = stack.pop()
+                if isinstance(obj, dict):
+                    if _is_car_ad(obj):
                         found.append(obj)
-                        return 
-                for v in obj.values():
-                    collect(v)
-            elif isinstance(obj, list):
-                for it in obj:
-                    collect(it)
-
-        collect(json_data)
+                        continue
+                    stack.extend(reversed(obj.values()))
+                elif isinstance(obj, list):
+                    stack.extend(reversed(obj))
 
         results: List[CarDTO] = []
         for d in found:
@@ -300,22 +364,19 @@ class AutoRiaScraper:
 
                 # Extract Details from basicInfo
                 mileage_th = 0
-                loc = ""
-                gear = ""
-                fuel = ""
+                details = {"location": "", "gearbox": "", "fuel": ""}
 
                 infos = d.get("basicInfo", [])
                 if isinstance(infos, list):
                     for info in infos:
                         txt = str(info.get("content") or "").strip()
                         icon = str((info.get("icon") or {}).get("data") or "")
-                        
-                        if "speedometer" in icon or "тис. км" in txt:
-                             m = re.search(r"(\d+)", txt.replace(" ", ""))
-                             if m: mileage_th = int(m.group(1))
-                        elif "location" in icon: loc = txt
-                        elif "automat" in icon or "transmission" in icon: gear = txt
-                        elif "fuel" in icon: fuel = txt
+                        field = next((f for tag, f in _ICON_FIELDS if tag in icon), "")
+
+                        if field == "mileage" or "тис. км" in txt:
+                            mileage_th = _first_number(txt) or mileage_th
+                        elif field:
+                            details[field] = txt
 
                 results.append(CarDTO(
                     id=int(car_id),
@@ -324,9 +385,7 @@ class AutoRiaScraper:
                     url=link,
                     mileage=mileage_th,
                     image_url=img,
-                    location=loc,
-                    gearbox=gear,
-                    fuel=fuel
+                    **details
                 ))
             except Exception:
                 continue
@@ -335,6 +394,48 @@ class AutoRiaScraper:
         unique_results = {c.id: c for c in results}
         return list(unique_results.values())
 
+    @staticmethod
+    def _find_offers_by_path(json_data: Any) -> List[Dict[str, Any]]:
+        """Returns the car ads found under the first matching `_PINIA_OFFER_PATHS` entry."""
+        for path in _PINIA_OFFER_PATHS:
+            cur = json_data
+            for k in path:
+                if not isinstance(cur, dict):
+                    break
+                cur = cur.get(k)
+            if isinstance(cur, list):
+                ads = [it for it in cur if isinstance(it, dict) and _is_car_ad(it)]
+                if ads:
+                    return ads
+        return []
+
+    @staticmethod
+    def _decode_state_json(html: str, marker: str) -> Optional[Any]:
+        """
+        Decodes the JSON object assigned to `marker` (e.g. `window.__PINIA__ = {...}`).
+        Mentions of the marker that are not an assignment (`if (window.__PINIA__)`) are
+        skipped. `raw_decode` finds the end of the object and parses it in one C-level
+        pass, straight from the page without slicing it first.
+        """
+        n = len(html)
+        idx = html.find(marker)
+        while idx != -1:
+            pos = idx + len(marker)
+            while pos < n and html[pos].isspace():
+                pos += 1
+            # `=` but not `==`/`===`, then the opening brace
+            if pos + 1 < n and html[pos] == "=" and html[pos + 1] != "=":
+                pos += 1
+                while pos < n and html[pos].isspace():
+                    pos += 1
+                if pos < n and html[pos] == "{":
+                    try:
+                        return _JSON_DECODER.raw_decode(html, pos)[0]
+                    except json.JSONDecodeError:
+                        logger.warning(f"Failed to decode {marker} JSON")
+            idx = html.find(marker, idx + len(marker))
+        return None
+
     async def _enrich_missing_details(self, session: aiohttp.ClientSession, cars: List[CarDTO]) -> List[CarDTO]:
         """
         Fetches the 'final page' API for cars that are missing critical details 
@@ -377,13 +478,11 @@ class AutoRiaScraper:
         route_path = self._route_path_from_url(car_url) or f"/uk/auto_{car_id}.html"
         url = self.FINAL_PAGE_URL.format(car_id=car_id)
         params = {"langId": "4", "device": "desktop-web", "ssr": "0", "routePath": route_path}
-        headers = dict(self.headers)
-        headers["Referer"] = car_url
-
         try:
-            async with session.get(url, params=params, headers=headers, timeout=self._details_timeout_sec) as r:
+            # Session headers are merged in by aiohttp; only the Referer is per request
+            async with session.get(url, params=params, headers={"Referer": car_url}, timeout=self._details_timeout_sec) as r:
                 if r.status != 200: return None
-                data = await r.json(content_type=None)
+                data = await self._json(r)
 
             # Deep search for key data in the response
             ld = self._find_key_recursive(data, "ldJSON") or {}
@@ -412,53 +511,60 @@ class AutoRiaScraper:
             return None
 
     @staticmethod
+    @lru_cache(maxsize=4096)
     def _route_path_from_url(url: str) -> str:
-        try:
-            return urlparse(url).path or ""
-        except Exception: return ""
+        """Path part of an absolute ad URL ("https://auto.ria.com/uk/auto_1.html?x" -> "/uk/auto_1.html")."""
+        scheme_end = url.find("://")
+        start = url.find("/", scheme_end + 3) if scheme_end != -1 else 0
+        if start == -1:
+            return ""
+        end = len(url)
+        for sep in "?#":
+            i = url.find(sep, start)
+            if i != -1 and i < end:
+                end = i
+        return url[start:end]
 
     @staticmethod
     def _find_key_recursive(obj: Any, key: str) -> Optional[Any]:
-        if isinstance(obj, dict):
-            if key in obj: return obj[key]
-            for v in obj.values():
-                res = AutoRiaScraper._find_key_recursive(v, key)
-                if res: return res
-        elif isinstance(obj, list):
-            for it in obj:
-                res = AutoRiaScraper._find_key_recursive(it, key)
-                if res: return res
+        """Returns the first non-empty value stored under `key` (pre-order, iterative)."""
+        stack: List[Any] = [obj]
+        while stack:
+            o = stack.pop()
+            if isinstance(o, dict):
+                if key in o:
+                    if o[key]: return o[key]
+                    continue
+                stack.extend(reversed(o.values()))
+            elif isinstance(o, list):
+                stack.extend(reversed(o))
         return None
 
     @staticmethod
     def _extract_location_best_effort(data: Any) -> Optional[str]:
         keys = {"city", "cityName", "locationCityName", "regionName", "stateName", "location", "locationName"}
-        def walk(obj: Any) -> Optional[str]:
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    if str(k) in keys and isinstance(v, str) and v.strip(): return v.strip()
-                    res = walk(v)
-                    if res: return res
-            elif isinstance(obj, list):
-                for it in obj:
-                    res = walk(it)
-                    if res: return res
-            return None
-        return walk(data)
+        # (key, value) pairs, so each key is checked right before its subtree is walked
+        stack: List[Tuple[Any, Any]] = [(None, data)]
+        while stack:
+            k, v = stack.pop()
+            if isinstance(v, str):
+                if str(k) in keys and v.strip(): return v.strip()
+            elif isinstance(v, dict):
+                stack.extend(reversed(v.items()))
+            elif isinstance(v, list):
+                stack.extend((None, it) for it in reversed(v))
+        return None
 
     @staticmethod
     def _extract_first_image_url(data: Any) -> str:
-        img_re = re.compile(r"^https?://.+\.(jpg|jpeg|png|webp)(\?.*)?$", re.IGNORECASE)
-        def walk(obj: Any) -> Optional[str]:
-            if isinstance(obj, str) and img_re.match(obj.strip()) and ("ria" in obj or "cdn" in obj):
-                return obj.strip()
-            if isinstance(obj, dict):
-                for v in obj.values():
-                    res = walk(v)
-                    if res: return res
-            if isinstance(obj, list):
-                for it in obj:
-                    res = walk(it)
-                    if res: return res
-            return None
-        return walk(data) or ""
\ No newline at end of file
+        stack: List[Any] = [data]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, str):
+                if _IMG_URL_RE.match(obj.strip()) and ("ria" in obj or "cdn" in obj):
+                    return obj.strip()
+            elif isinstance(obj, dict):
+                stack.extend(reversed(obj.values()))
+            elif isinstance(obj, list):
+                stack.extend(reversed(obj))
+        return ""
\ No newline at end of file